@@ -19,8 +19,7 @@ import torch.nn.functional as F
 
 sys.path.append('../')
 
-from utils.torch_utils import to_cpu
-from utils.iou_rotated_boxes_utils import iou_pred_vs_target_boxes, get_polygons_fix_xy, iou_rotated_boxes_vs_anchors
+from utils.iou_rotated_boxes_utils import iou_pred_vs_target_boxes, get_corners_torch, iou_rotated_boxes_vs_anchors
 
 
 class YoloLayer(nn.Module):
@@ -49,49 +48,53 @@ class YoloLayer(nn.Module):
         # Initialize dummy variables
         self.grid_size = 0
         self.img_size = 0
+        self.grid_cache = {}
         self.metrics = {}
 
     def compute_grid_offsets(self, grid_size):
         self.grid_size = grid_size
-        g = self.grid_size
-        self.stride = self.img_size / self.grid_size
-        # Calculate offsets for each grid
-        self.grid_x = torch.arange(g, device=self.device, dtype=torch.float).repeat(g, 1).view([1, 1, g, g])
-        self.grid_y = torch.arange(g, device=self.device, dtype=torch.float).repeat(g, 1).t().view([1, 1, g, g])
-        self.scaled_anchors = torch.tensor(
-            [(a_w / self.stride, a_h / self.stride, im, re) for a_w, a_h, im, re in self.anchors], device=self.device,
-            dtype=torch.float)
-        self.anchor_w = self.scaled_anchors[:, 0:1].view((1, self.num_anchors, 1, 1))
-        self.anchor_h = self.scaled_anchors[:, 1:2].view((1, self.num_anchors, 1, 1))
-
-        # Pre compute polygons and areas of anchors
-        self.scaled_anchors_polygons = get_polygons_fix_xy(to_cpu(self.scaled_anchors).numpy(), fix_xy=100)
-        self.scaled_anchors_areas = [polygon_.area for polygon_ in self.scaled_anchors_polygons]
-
-    def build_targets(self, out_boxes, pred_cls, target, anchors):
+        # Multi-scale training switches between a few grid sizes, so reuse the offsets of the ones already seen
+        cache_key = (grid_size, self.img_size, self.device)
+        if cache_key not in self.grid_cache:
+            g = self.grid_size
+            stride = self.img_size / self.grid_size
+            # Calculate offsets for each grid
+            grid_range = torch.arange(g, device=self.device, dtype=torch.float)
+            grid_y, grid_x = torch.meshgrid(grid_range, grid_range)
+            grid_xy = torch.stack((grid_x, grid_y), dim=0).view([1, 1, 2, g, g])
+            scaled_anchors = torch.tensor(
+                [(a_w / stride, a_h / stride, im, re) for a_w, a_h, im, re in self.anchors], device=self.device,
+                dtype=torch.float)
+            # Contiguous per-anchor w, h for the per-target gathers in build_targets()
+            scaled_anchor_w = scaled_anchors[:, 0].contiguous()
+            scaled_anchor_h = scaled_anchors[:, 1].contiguous()
+            # Pre compute conners and areas of anchors
+            scaled_anchors_conners = get_corners_torch(scaled_anchors)
+            scaled_anchors_areas = scaled_anchor_w * scaled_anchor_h
+            anchor_wh = scaled_anchors[:, :2].reshape((1, self.num_anchors, 2, 1, 1))
+            self.grid_cache[cache_key] = (stride, grid_xy, scaled_anchor_w, scaled_anchor_h, scaled_anchors_conners,
+                                          scaled_anchors_areas, anchor_wh)
+
+        self.stride, self.grid_xy, self.scaled_anchor_w, self.scaled_anchor_h, self.scaled_anchors_conners, \
+            self.scaled_anchors_areas, self.anchor_wh = self.grid_cache[cache_key]
+
+    def build_targets(self, out_boxes, pred_cls, target):
         """ Built yolo targets to compute loss
-        :param out_boxes: [num_samples or batch, num_anchors, grid_size, grid_size, 6]
-        :param pred_cls: [num_samples or batch, num_anchors, grid_size, grid_size, num_classes]
+        :param out_boxes: [num_samples or batch, num_anchors, 6, grid_size, grid_size]
+        :param pred_cls: [num_samples or batch, num_anchors, num_classes, grid_size, grid_size]
         :param target: [num_boxes, 8]
-        :param anchors: [num_anchors, 4]
         :return:
         """
-        nB, nA, nG, _, nC = pred_cls.size()
+        nB, nA, nC, nG, _ = pred_cls.size()
         n_target_boxes = target.size(0)
 
         # Create output tensors on "device"
-        obj_mask = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.uint8)
-        noobj_mask = torch.full(size=(nB, nA, nG, nG), fill_value=1, device=self.device, dtype=torch.uint8)
-        class_mask = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        iou_scores = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        tx = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        ty = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        tw = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        th = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        tim = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        tre = torch.full(size=(nB, nA, nG, nG), fill_value=0, device=self.device, dtype=torch.float)
-        tcls = torch.full(size=(nB, nA, nG, nG, nC), fill_value=0, device=self.device, dtype=torch.float)
-        tconf = obj_mask.float()
+        obj_mask = torch.zeros(size=(nB, nA, nG, nG), device=self.device, dtype=torch.bool)
+        noobj_mask = torch.ones(size=(nB, nA, nG, nG), device=self.device, dtype=torch.bool)
+        # The float targets are views of a single zero-filled buffer
+        iou_scores, class_mask, tx, ty, tw, th, tim, tre = torch.zeros(size=(8, nB, nA, nG, nG), device=self.device,
+                                                                      dtype=torch.float)
+        tcls = torch.zeros(size=(nB, nA, nG, nG, nC), device=self.device, dtype=torch.float)
 
         if n_target_boxes > 0:  # Make sure that there is at least 1 box
             # Convert to position relative to box
@@ -101,12 +104,11 @@ class YoloLayer(nn.Module):
             gwh = target_boxes[:, 2:4] * nG  # scale up w, l
             gimre = target_boxes[:, 4:]
 
-            targets_polygons = get_polygons_fix_xy(to_cpu(target_boxes[:, 2:6] * nG).numpy(), fix_xy=100)
-            targets_areas = [polygon_.area for polygon_ in targets_polygons]
-
-            # Get anchors with best iou
-            ious = iou_rotated_boxes_vs_anchors(self.scaled_anchors_polygons, self.scaled_anchors_areas,
-                                                targets_polygons, targets_areas)
+            # Get anchors with best iou, ious size: (num_anchors, n_target_boxes)
+            targets_conners = get_corners_torch(torch.cat((gwh, gimre), dim=-1))
+            targets_areas = gwh[:, 0] * gwh[:, 1]
+            ious = iou_rotated_boxes_vs_anchors(self.scaled_anchors_conners, self.scaled_anchors_areas,
+                                                targets_conners, targets_areas)
             best_ious, best_n = ious.max(0)
 
             b, target_labels = target[:, :2].long().t()
@@ -115,32 +117,40 @@ class YoloLayer(nn.Module):
             gw, gh = gwh.t()
             gim, gre = gimre.t()
             gi, gj = gxy.long().t()
+            # Index of the cell and anchor responsible for each target box, shared by all the writes below
+            cell_idx = (b, best_n, gj, gi)
             # Set masks
-            obj_mask[b, best_n, gj, gi] = 1
-            noobj_mask[b, best_n, gj, gi] = 0
+            obj_mask[cell_idx] = True
+            noobj_mask[cell_idx] = False
 
             # Set noobj mask to zero where iou exceeds ignore threshold
-            for i, anchor_ious in enumerate(ious.t()):
-                noobj_mask[b[i], anchor_ious > self.ignore_thresh, gj[i], gi[i]] = 0
+            ignore_t, ignore_a = (ious.t() > self.ignore_thresh).nonzero(as_tuple=True)
+            noobj_mask[b[ignore_t], ignore_a, gj[ignore_t], gi[ignore_t]] = False
 
             # Coordinates
-            tx[b, best_n, gj, gi] = gx - gx.floor()
-            ty[b, best_n, gj, gi] = gy - gy.floor()
+            tx[cell_idx] = gx - gx.floor()
+            ty[cell_idx] = gy - gy.floor()
             # Width and height
-            tw[b, best_n, gj, gi] = torch.log(gw / anchors[best_n][:, 0] + 1e-16)
-            th[b, best_n, gj, gi] = torch.log(gh / anchors[best_n][:, 1] + 1e-16)
+            tw[cell_idx] = torch.log(gw / self.scaled_anchor_w[best_n] + 1e-16)
+            th[cell_idx] = torch.log(gh / self.scaled_anchor_h[best_n] + 1e-16)
             # Im and real part
-            tim[b, best_n, gj, gi] = gim
-            tre[b, best_n, gj, gi] = gre
+            tim[cell_idx] = gim
+            tre[cell_idx] = gre
 
             # One-hot encoding of label
-            tcls[b, best_n, gj, gi, target_labels] = 1
-            class_mask[b, best_n, gj, gi] = (pred_cls[b, best_n, gj, gi].argmax(-1) == target_labels).float()
-            iou_scores[b, best_n, gj, gi] = iou_pred_vs_target_boxes(out_boxes[b, best_n, gj, gi], target_boxes, nG)
-            tconf = obj_mask.float()
+            tcls[cell_idx + (target_labels,)] = 1
+            # Both ways read nC scores per cell, the argmax over the whole grid is only cheaper when there are
+            # fewer grid cells than target boxes
+            if nB * nA * nG * nG < n_target_boxes:
+                pred_labels = pred_cls.argmax(2)[cell_idx]
+            else:
+                pred_labels = pred_cls[b, best_n, :, gj, gi].argmax(-1)
+            class_mask[cell_idx] = (pred_labels == target_labels).float()
+            iou_scores[cell_idx] = iou_pred_vs_target_boxes(out_boxes[b, best_n, :, gj, gi], target_boxes, nG)
+
+        tconf = obj_mask.float()
 
-        return iou_scores, class_mask, obj_mask.type(torch.bool), noobj_mask.type(torch.bool), \
-               tx, ty, tw, th, tim, tre, tcls, tconf
+        return iou_scores, class_mask, obj_mask, noobj_mask, tx, ty, tw, th, tim, tre, tcls, tconf
 
     def forward(self, x, targets=None, img_size=608):
         """
@@ -153,40 +163,43 @@ class YoloLayer(nn.Module):
         self.device = x.device
         num_samples, _, _, grid_size = x.size()
 
+        # Work on the channels of the conv output directly, only the exported output is permuted
         prediction = x.view(num_samples, self.num_anchors, self.num_classes + 7, grid_size, grid_size)
-        prediction = prediction.permute(0, 1, 3, 4, 2).contiguous()
-        # prediction size: [num_samples, num_anchors, grid_size, grid_size, num_classes + 7]
+        # prediction size: [num_samples, num_anchors, num_classes + 7, grid_size, grid_size]
 
         # Get outputs
-        pred_x = torch.sigmoid(prediction[..., 0])
-        pred_y = torch.sigmoid(prediction[..., 1])
-        pred_w = prediction[..., 2]  # Width
-        pred_h = prediction[..., 3]  # Height
-        pred_im = prediction[..., 4]  # angle imaginary part
-        pred_re = prediction[..., 5]  # angle real part
-        pred_conf = torch.sigmoid(prediction[..., 6])  # Conf
-        pred_cls = torch.sigmoid(prediction[..., 7:])  # Cls pred.
+        pred_xy_logits = prediction[:, :, :2]  # Center x, y
+        pred_wh = prediction[:, :, 2:4]  # Width, Height
+        pred_imre = prediction[:, :, 4:6]  # angle imaginary part, real part
+        pred_conf_logits = prediction[:, :, 6]  # Conf
+        pred_cls_logits = prediction[:, :, 7:]  # Cls pred.
+        # Conf + Cls, size: [num_samples, num_anchors, 1 + num_classes, grid_size, grid_size]
+        pred_conf_cls_logits = prediction[:, :, 6:]
 
         # If grid size does not match current we compute new offsets
         if grid_size != self.grid_size:
             self.compute_grid_offsets(grid_size)
 
         # Add offset and scale with anchors
-        # pred_boxes size: [num_samples, num_anchors, grid_size, grid_size, 6]
-        out_boxes = torch.empty(prediction[..., :6].shape, device=self.device, dtype=torch.float)
-        out_boxes[..., 0] = pred_x.clone().detach() + self.grid_x
-        out_boxes[..., 1] = pred_y.clone().detach() + self.grid_y
-        out_boxes[..., 2] = torch.exp(pred_w.clone().detach()) * self.anchor_w
-        out_boxes[..., 3] = torch.exp(pred_h.clone().detach()) * self.anchor_h
-        out_boxes[..., 4] = pred_im.clone().detach()
-        out_boxes[..., 5] = pred_re.clone().detach()
-
-        output = torch.cat((
-            out_boxes[..., :4].view(num_samples, -1, 4) * self.stride,
-            out_boxes[..., 4:6].view(num_samples, -1, 2),
-            pred_conf.clone().view(num_samples, -1, 1),
-            pred_cls.clone().view(num_samples, -1, self.num_classes),
-        ), dim=-1)
+        # out_boxes size: [num_samples, num_anchors, 6, grid_size, grid_size]
+        with torch.no_grad():
+            # One sigmoid for the center and one for the conf + cls channels
+            pred_xy = torch.sigmoid(pred_xy_logits)
+            pred_conf_cls = torch.sigmoid(pred_conf_cls_logits)
+            pred_cls = pred_conf_cls[:, :, 1:]
+            out_boxes = torch.cat((
+                pred_xy + self.grid_xy,
+                torch.exp(pred_wh) * self.anchor_wh,
+                pred_imre,
+            ), dim=2)
+
+        # The copies into the channel-last output do the permutation
+        output = torch.empty((num_samples, self.num_anchors, grid_size, grid_size, 7 + self.num_classes),
+                             device=self.device, dtype=x.dtype)
+        torch.mul(out_boxes[:, :, :4].permute(0, 1, 3, 4, 2), self.stride, out=output[..., :4])
+        output[..., 4:6].copy_(out_boxes[:, :, 4:6].permute(0, 1, 3, 4, 2))
+        output[..., 6:].copy_(pred_conf_cls.permute(0, 1, 3, 4, 2))
+        output = output.view(num_samples, -1, 7 + self.num_classes)
         # output size: [num_samples, num boxes, 7 + num_classes]
 
         if targets is None:
@@ -194,23 +207,30 @@ class YoloLayer(nn.Module):
         else:
             reduction = 'mean'
             iou_scores, class_mask, obj_mask, noobj_mask, tx, ty, tw, th, tim, tre, tcls, tconf = self.build_targets(
-                out_boxes=out_boxes, pred_cls=pred_cls, target=targets, anchors=self.scaled_anchors)
+                out_boxes=out_boxes, pred_cls=pred_cls, target=targets)
 
             iou_masked = iou_scores[obj_mask]  # size: (n_target_boxes,)
             loss_box = (1. - iou_masked).sum() if reduction == 'sum' else (1. - iou_masked).mean()
 
-            loss_conf_obj = F.binary_cross_entropy(pred_conf[obj_mask], tconf[obj_mask], reduction=reduction)
-            loss_conf_noobj = F.binary_cross_entropy(pred_conf[noobj_mask], tconf[noobj_mask], reduction=reduction)
-            loss_obj = self.obj_scale * loss_conf_obj + self.noobj_scale * loss_conf_noobj
-            loss_cls = F.binary_cross_entropy(pred_cls[obj_mask], tcls[obj_mask], reduction=reduction)
+            # The obj and noobj terms are computed by one weighted BCE, each one is still reduced over its own cells
+            if reduction == 'sum':
+                n_obj, n_noobj = 1., 1.
+            else:
+                n_obj, n_noobj = obj_mask.sum().clamp(min=1).float(), noobj_mask.sum().clamp(min=1).float()
+            conf_weight = obj_mask.float() * (self.obj_scale / n_obj) + \
+                          noobj_mask.float() * (self.noobj_scale / n_noobj)
+            loss_obj = F.binary_cross_entropy_with_logits(pred_conf_logits, tconf, weight=conf_weight, reduction='sum')
+            loss_cls = F.binary_cross_entropy_with_logits(pred_cls_logits.permute(0, 1, 3, 4, 2)[obj_mask],
+                                                          tcls[obj_mask], reduction=reduction)
             total_loss = loss_box * self.lbox_scale + loss_obj * self.lobj_scale + loss_cls * self.lcls_scale
 
             # Metrics (store loss values using tensorboard)
+            # Keep them on device, they are only copied to cpu when logging to avoid a sync per iteration
             self.metrics = {
-                "loss": to_cpu(total_loss).item(),
-                'loss_box': to_cpu(loss_box).item(),
-                "loss_obj": to_cpu(loss_obj).item(),
-                "loss_cls": to_cpu(loss_cls).item()
+                "loss": total_loss.detach(),
+                'loss_box': loss_box.detach(),
+                "loss_obj": loss_obj.detach(),
+                "loss_cls": loss_cls.detach()
             }
 
             return output, total_loss
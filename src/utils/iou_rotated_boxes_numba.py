@@ -0,0 +1,94 @@
+"""
+# -*- coding: utf-8 -*-
+-----------------------------------------------------------------------------------
+# Author: Nguyen Mau Dung
+# DoC: 2026.10.14
+# email: nguyenmaudung93.kstn@gmail.com
+-----------------------------------------------------------------------------------
+# Description: numba kernels to compute the IoU of rotated boxes on cpu
+"""
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(cache=True, fastmath=True)
+def polygon_area(xs, ys, n):
+    area = 0.
+    for i in range(n):
+        j = (i + 1) % n
+        area += xs[i] * ys[j] - xs[j] * ys[i]
+
+    return abs(area) * 0.5
+
+
+@njit(cache=True, fastmath=True)
+def intersection_area_2_polygons(conners_1, conners_2):
+    """Sutherland-Hodgman clipping of the quadrilateral conners_1 by the convex quadrilateral conners_2
+
+    :param conners_1: [4, 2]
+    :param conners_2: [4, 2]
+    :return: the intersection area
+    """
+    # Clipping a quadrilateral by 4 half-planes gives at most 8 vertices
+    in_x = np.empty(16, dtype=np.float32)
+    in_y = np.empty(16, dtype=np.float32)
+    out_x = np.empty(16, dtype=np.float32)
+    out_y = np.empty(16, dtype=np.float32)
+    for i in range(4):
+        in_x[i] = conners_1[i, 0]
+        in_y[i] = conners_1[i, 1]
+    n_in = 4
+
+    # Orientation of the clipping polygon, so that the inside is where the side values are positive
+    signed_area = 0.
+    for i in range(4):
+        j = (i + 1) % 4
+        signed_area += conners_2[i, 0] * conners_2[j, 1] - conners_2[j, 0] * conners_2[i, 1]
+    orient = 1. if signed_area >= 0 else -1.
+
+    for e in range(4):
+        x1, y1 = conners_2[e, 0], conners_2[e, 1]
+        x2, y2 = conners_2[(e + 1) % 4, 0], conners_2[(e + 1) % 4, 1]
+        n_out = 0
+        prev_x, prev_y = in_x[n_in - 1], in_y[n_in - 1]
+        prev_side = orient * ((x2 - x1) * (prev_y - y1) - (y2 - y1) * (prev_x - x1))
+        for i in range(n_in):
+            cur_x, cur_y = in_x[i], in_y[i]
+            cur_side = orient * ((x2 - x1) * (cur_y - y1) - (y2 - y1) * (cur_x - x1))
+            if (cur_side >= 0) != (prev_side >= 0):
+                # The edge prev --> cur crosses the clipping line
+                t = prev_side / (prev_side - cur_side)
+                out_x[n_out] = prev_x + t * (cur_x - prev_x)
+                out_y[n_out] = prev_y + t * (cur_y - prev_y)
+                n_out += 1
+            if cur_side >= 0:
+                out_x[n_out] = cur_x
+                out_y[n_out] = cur_y
+                n_out += 1
+            prev_x, prev_y, prev_side = cur_x, cur_y, cur_side
+
+        if n_out < 3:
+            return 0.
+        in_x, out_x = out_x, in_x
+        in_y, out_y = out_y, in_y
+        n_in = n_out
+
+    return polygon_area(in_x, in_y, n_in)
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def iou_rotated_boxes_vs_anchors_numba(anchors_conners, anchors_areas, targets_conners, targets_areas, ious):
+    """Fill ious [num_anchors, num_targets_boxes] with the IoU of every pair of anchor and target box
+
+    :param anchors_conners: [num_anchors, 4, 2]
+    :param anchors_areas: [num_anchors]
+    :param targets_conners: [num_targets_boxes, 4, 2]
+    :param targets_areas: [num_targets_boxes]
+    """
+    num_anchors = anchors_conners.shape[0]
+    num_targets_boxes = targets_conners.shape[0]
+    for tg_idx in prange(num_targets_boxes):
+        for ac_idx in range(num_anchors):
+            intersection = intersection_area_2_polygons(anchors_conners[ac_idx], targets_conners[tg_idx])
+            ious[ac_idx, tg_idx] = intersection / (anchors_areas[ac_idx] + targets_areas[tg_idx] - intersection + 1e-12)
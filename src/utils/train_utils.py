@@ -116,7 +116,13 @@ def get_tensorboard_log(model):
             if j == 0:
                 tensorboard_log['{}'.format(name)] = metric
             else:
-                tensorboard_log['{}'.format(name)] += metric
+                tensorboard_log['{}'.format(name)] = tensorboard_log['{}'.format(name)] + metric
+
+    # The yolo layers keep their metrics on device, copy all of them to cpu at once
+    if len(tensorboard_log) > 0:
+        names = list(tensorboard_log.keys())
+        values = torch.stack([tensorboard_log[name] for name in names]).cpu().tolist()
+        tensorboard_log = dict(zip(names, values))
 
     return tensorboard_log
 